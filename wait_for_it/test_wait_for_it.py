@@ -1,11 +1,17 @@
 """wait_for_it cli test module"""
 
+import asyncio
+import errno
+import json
+import os
 import socket
+import struct
 import subprocess
 
 from unittest.mock import call, Mock, patch
 
 import socketserver
+from tempfile import TemporaryDirectory
 from threading import Event, Thread
 from unittest import TestCase
 
@@ -13,8 +19,20 @@ from click.testing import CliRunner
 from parameterized import parameterized
 from .wait_for_it import (
     cli,
+    connect,
+    _AmqpProbe,
+    _classify_failure,
     _determine_host_and_port_for,
+    _determine_probe_class_for,
+    _FailureCategory,
+    _KafkaProbe,
     _MalformedServiceSyntaxException,
+    _Phase,
+    _ProbeHooks,
+    _PostgresProbe,
+    _RedisProbe,
+    _RetryPolicy,
+    _TcpProbe,
 )
 
 _ANY_FREE_PORT = 0
@@ -29,13 +47,14 @@ class _DummyTcpServerThread(Thread):
     class _DummyHandler(socketserver.BaseRequestHandler):
         pass
 
-    def __init__(self):
+    def __init__(self, handler_class=_DummyHandler):
         super().__init__()
         self.started = Event()
+        self._handler_class = handler_class
 
     def run(self):
         with socketserver.TCPServer(
-            ("127.0.0.1", _ANY_FREE_PORT), self._DummyHandler
+            ("127.0.0.1", _ANY_FREE_PORT), self._handler_class
         ) as self._server:
             self.host, self.port = self._server.server_address
             self.started.set()
@@ -45,8 +64,64 @@ class _DummyTcpServerThread(Thread):
         self._server.shutdown()
 
 
-def _start_server_thread():
-    server = _DummyTcpServerThread()
+class _RedisHandler(socketserver.StreamRequestHandler):
+    """Answers PING with "-LOADING" for the first ``loading_replies`` times"""
+
+    loading_replies = 0
+    connection_count = 0
+
+    def handle(self):
+        type(self).connection_count += 1
+        for _array_header in iter(self.rfile.readline, b""):
+            self.rfile.readline()  # bulk string header
+            self.rfile.readline()  # command name, i.e. PING
+            if type(self).loading_replies > 0:
+                type(self).loading_replies -= 1
+                self.wfile.write(b"-LOADING Redis is loading the dataset in memory\r\n")
+            else:
+                self.wfile.write(b"+PONG\r\n")
+
+
+class _PostgresHandler(socketserver.StreamRequestHandler):
+    sqlstate = None
+
+    def handle(self):
+        (length,) = struct.unpack("!i", self.rfile.read(4))
+        self.rfile.read(length - 4)
+        if self.sqlstate is None:
+            self.wfile.write(b"R" + struct.pack("!ii", 8, 0))  # AuthenticationOk
+        else:
+            fields = b"SFATAL\0C" + self.sqlstate + b"\0\0"
+            self.wfile.write(b"E" + struct.pack("!i", 4 + len(fields)) + fields)
+
+
+class _AmqpHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.rfile.read(8)
+        payload = struct.pack("!HHBB", 10, 10, 0, 9)  # Connection.Start, 0-9
+        self.wfile.write(struct.pack("!BHI", 1, 0, len(payload)) + payload + b"\xce")
+
+
+class _KafkaHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        (size,) = struct.unpack("!i", self.rfile.read(4))
+        (correlation_id,) = struct.unpack("!4xi", self.rfile.read(size)[:8])
+        response = struct.pack("!ihi", correlation_id, 0, 0)
+        self.wfile.write(struct.pack("!i", len(response)) + response)
+
+
+class _MalformedReplyHandler(socketserver.StreamRequestHandler):
+    """Answers anything with ``reply``, e.g. with a bogus length field"""
+
+    reply = b""
+
+    def handle(self):
+        self.rfile.read(1)
+        self.wfile.write(self.reply)
+
+
+def _start_server_thread(handler_class=_DummyTcpServerThread._DummyHandler):
+    server = _DummyTcpServerThread(handler_class)
     server.start()
     server.started.wait()
     return server
@@ -145,6 +220,168 @@ class CliTest(TestCase):
         finally:
             sock.close()
 
+    @parameterized.expand([("parallel", ["-p"]), ("serial", [])])
+    def test_service_malformed_host_fails_fast(self, _label, extra_argv):
+        result = self._runner.invoke(cli, ["-t0", "-s", "bad..host:80"] + extra_argv)
+        assert "bad..host:80 can never become available: " in result.output
+        assert result.exit_code == 1
+
+    def test_service_unresolvable_host_retried(self):
+        result = self._runner.invoke(cli, ["-t1", "-s", "unresolvable.invalid:80"])
+        assert result.output.count("Timeout occurred") == 1
+        assert result.exit_code == 1
+
+    @parameterized.expand(
+        [
+            ("redis", _RedisHandler),
+            ("postgres", _PostgresHandler),
+            ("amqp", _AmqpHandler),
+            ("kafka", _KafkaHandler),
+        ]
+    )
+    def test_protocol_service_available(self, scheme, handler_class):
+        server = _start_server_thread(handler_class)
+        try:
+            result = self._runner.invoke(
+                cli, ["-t1", "-s", f"{scheme}://{server.host}:{server.port}"]
+            )
+            assert result.output.count(" is available after ") == 1
+            assert result.exit_code == 0
+        finally:
+            server.stop()
+
+    @parameterized.expand([("redis",), ("postgres",), ("amqp",), ("kafka",)])
+    def test_protocol_service_silent(self, scheme):
+        server = _start_server_thread()
+        try:
+            result = self._runner.invoke(
+                cli, ["-t1", "-s", f"{scheme}://{server.host}:{server.port}"]
+            )
+            assert result.output.count("Timeout occurred") == 1
+            assert result.exit_code == 1
+        finally:
+            server.stop()
+
+    @parameterized.expand(
+        [
+            ("kafka", b"\xff\xff\xff\xff"),  # negative size
+            ("postgres", b"E\0\0\0\0"),  # length too small
+        ]
+    )
+    def test_protocol_service_malformed_reply_retried(self, scheme, reply):
+        handler_class = type(
+            "_SpecificMalformedReplyHandler",
+            (_MalformedReplyHandler,),
+            {"reply": reply},
+        )
+        server = _start_server_thread(handler_class)
+        try:
+            result = self._runner.invoke(
+                cli, ["-t2", "-s", f"{scheme}://{server.host}:{server.port}"]
+            )
+            assert "can never become available" not in result.output
+            assert result.output.count("Timeout occurred") == 1
+            assert result.exit_code == 1
+        finally:
+            server.stop()
+
+    def test_redis_connection_reused_while_loading(self):
+        _RedisHandler.loading_replies = 2
+        _RedisHandler.connection_count = 0
+        server = _start_server_thread(_RedisHandler)
+        try:
+            result = self._runner.invoke(
+                cli, ["-t5", "-s", f"redis://{server.host}:{server.port}"]
+            )
+            assert result.output.count(" is available after ") == 1
+            assert result.exit_code == 0
+            assert _RedisHandler.loading_replies == 0
+            assert _RedisHandler.connection_count == 1
+        finally:
+            server.stop()
+
+    def test_postgres_starting_up(self):
+        handler_class = type(
+            "_StartingUpHandler", (_PostgresHandler,), {"sqlstate": b"57P03"}
+        )
+        server = _start_server_thread(handler_class)
+        try:
+            result = self._runner.invoke(
+                cli, ["-t1", "-s", f"postgres://{server.host}:{server.port}"]
+            )
+            assert result.output.count("Timeout occurred") == 1
+            assert result.exit_code == 1
+        finally:
+            server.stop()
+
+    @parameterized.expand([("parallel", ["-p"]), ("serial", [])])
+    def test_trace(self, _label, extra_argv):
+        server = _start_server_thread()
+        try:
+            with TemporaryDirectory() as temp_dir:
+                trace_filename = os.path.join(temp_dir, "trace.json")
+                result = self._runner.invoke(
+                    cli,
+                    ["-t1", "--trace", trace_filename]
+                    + ["-s", f"{server.host}:{server.port}"]
+                    + extra_argv,
+                )
+                with open(trace_filename) as f:
+                    trace = json.load(f)
+            assert result.exit_code == 0
+            phase_names = [
+                event["name"] for event in trace["traceEvents"] if event["ph"] == "X"
+            ]
+            assert phase_names == ["resolve", "connect", "handshake", "close"]
+        finally:
+            server.stop()
+
+
+class _RecordingHooks(_ProbeHooks):
+    def __init__(self):
+        self.calls = []
+
+    def on_phase_start(self, probe, phase):
+        self.calls.append(("start", phase, None))
+
+    def on_phase_end(self, probe, phase, error):
+        self.calls.append(("end", phase, type(error)))
+
+
+class ProbeHooksTest(TestCase):
+    def test_phases_of_retry(self):
+        _RedisHandler.loading_replies = 1
+        hooks = _RecordingHooks()
+        server = _start_server_thread(_RedisHandler)
+        try:
+            connect(f"redis://{server.host}:{server.port}", 5, hooks)
+        finally:
+            server.stop()
+        assert hooks.calls == [
+            ("start", _Phase.RESOLVE, None),
+            ("end", _Phase.RESOLVE, type(None)),
+            ("start", _Phase.CONNECT, None),
+            ("end", _Phase.CONNECT, type(None)),
+            ("start", _Phase.HANDSHAKE, None),
+            ("end", _Phase.HANDSHAKE, type(None)),
+            ("start", _Phase.SLEEP, None),
+            ("end", _Phase.SLEEP, type(None)),
+            ("start", _Phase.HANDSHAKE, None),  # i.e. connection reused
+            ("end", _Phase.HANDSHAKE, type(None)),
+            ("start", _Phase.CLOSE, None),
+            ("end", _Phase.CLOSE, type(None)),
+        ]
+
+    def test_failed_phase(self):
+        _, port, sock = _occupy_free_tcp_port("127.0.0.1")
+        hooks = _RecordingHooks()
+        try:
+            with self.assertRaises(SystemExit):
+                connect(f"127.0.0.1:{port}", 1, hooks)
+        finally:
+            sock.close()
+        assert ("end", _Phase.CONNECT, ConnectionRefusedError) in hooks.calls
+
 
 class DetermineHostAndPortForTest(TestCase):
     @parameterized.expand(
@@ -159,6 +396,11 @@ class DetermineHostAndPortForTest(TestCase):
             ("http://domain.ext/path/", "domain.ext", 80),
             ("https://domain.ext", "domain.ext", 443),
             ("https://domain.ext/path/", "domain.ext", 443),
+            ("redis://domain.ext", "domain.ext", 6379),
+            ("postgres://user@domain.ext/db", "domain.ext", 5432),
+            ("postgresql://domain.ext:1", "domain.ext", 1),
+            ("amqp://domain.ext", "domain.ext", 5672),
+            ("kafka://domain.ext", "domain.ext", 9092),
         ]
     )
     def test_supported(self, service, expected_host, expected_port):
@@ -177,3 +419,81 @@ class DetermineHostAndPortForTest(TestCase):
     def test_rejected(self, service):
         with self.assertRaises(_MalformedServiceSyntaxException):
             _determine_host_and_port_for(service)
+
+
+class DetermineProbeClassForTest(TestCase):
+    @parameterized.expand(
+        [
+            (":1234", _TcpProbe),
+            ("domain.ext", _TcpProbe),
+            ("https://domain.ext", _TcpProbe),
+            ("unknown://domain.ext", _TcpProbe),
+            ("redis://domain.ext", _RedisProbe),
+            ("postgres://domain.ext", _PostgresProbe),
+            ("postgresql://domain.ext", _PostgresProbe),
+            ("amqp://domain.ext", _AmqpProbe),
+            ("kafka://domain.ext", _KafkaProbe),
+        ]
+    )
+    def test(self, service, expected_probe_class):
+        assert _determine_probe_class_for(service) is expected_probe_class
+
+
+class ClassifyFailureTest(TestCase):
+    @parameterized.expand(
+        [
+            (ConnectionRefusedError(errno.ECONNREFUSED, ""), _FailureCategory.REFUSED),
+            (socket.gaierror(socket.EAI_NONAME, ""), _FailureCategory.DNS),
+            (socket.gaierror(socket.EAI_AGAIN, ""), _FailureCategory.DNS),
+            (socket.gaierror(socket.EAI_SERVICE, ""), _FailureCategory.PERMANENT),
+            (OSError(errno.EHOSTUNREACH, ""), _FailureCategory.UNREACHABLE),
+            (OSError(errno.ENETUNREACH, ""), _FailureCategory.UNREACHABLE),
+            (UnicodeError("label empty or too long"), _FailureCategory.PERMANENT),
+            (TypeError(), _FailureCategory.PERMANENT),
+            (ConnectionResetError(errno.ECONNRESET, ""), _FailureCategory.NOT_READY),
+            (EOFError(), _FailureCategory.NOT_READY),
+            (struct.error(), _FailureCategory.NOT_READY),
+        ]
+    )
+    def test(self, error, expected_category):
+        assert _classify_failure(error) is expected_category
+
+
+class TcpProbeConnectTest(TestCase):
+    def test_refused_on_all_addresses_classified_refused(self):
+        _, port, sock = _occupy_free_tcp_port("127.0.0.1")
+
+        async def _getaddrinfo(*args, **kwargs):
+            # Two addresses, as for "localhost" on a dual-stack host
+            return [
+                (socket.AF_INET, socket.SOCK_STREAM, 6, "", (host, port))
+                for host in ("127.0.0.1", "127.0.0.2")
+            ]
+
+        probe = _TcpProbe("localhost", port)
+        try:
+            loop = asyncio.new_event_loop()
+            try:
+                with patch.object(loop, "getaddrinfo", _getaddrinfo):
+                    with self.assertRaises(OSError) as context:
+                        loop.run_until_complete(probe.attempt())
+            finally:
+                loop.close()
+        finally:
+            sock.close()
+        assert _classify_failure(context.exception) is _FailureCategory.REFUSED
+
+
+class RetryPolicyTest(TestCase):
+    @parameterized.expand([(1, 0.5), (2, 1), (3, 2), (4, 3), (100, 3)])
+    def test_delay_after(self, consecutive_failures, expected_delay):
+        policy = _RetryPolicy(0.5, 3)
+        assert policy.delay_after(consecutive_failures) == expected_delay
+
+    def test_delay_after_many_failures(self):
+        policy = _RetryPolicy(0.1, 0.5)
+        assert policy.delay_after(1030) == policy.delay_after(10**9) == 0.5
+
+    def test_constant_delay_by_default(self):
+        policy = _RetryPolicy(1)
+        assert policy.delay_after(1) == policy.delay_after(5) == 1
@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 import asyncio
+import errno
+import json
 import os
 import signal
 import socket
+import struct
 import subprocess
 import sys
 import time
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from enum import Enum
 from urllib.parse import urlparse
 
@@ -24,33 +27,448 @@ class _MalformedServiceSyntaxException(_WaitForItException):
         super().__init__(f"{service!r} is not a supported syntax for a service")
 
 
-def _determine_host_and_port_for(service):
+class _PermanentFailureException(_WaitForItException):
+    def __init__(self, host, port, error):
+        super().__init__(
+            f"{_friendly_name_for(host, port)} can never become available: {error}"
+        )
+
+
+def _parse_service(service):
     scheme, _, host = service.rpartition(r"//")
     try:
-        url = urlparse(f"{scheme}//{host}", scheme="http")
+        return urlparse(f"{scheme}//{host}", scheme="http")
+    except ValueError:
+        raise _MalformedServiceSyntaxException(service)
+
+
+def _determine_host_and_port_for(service):
+    url = _parse_service(service)
+    try:
         host = url.hostname
-        port = url.port or (443 if url.scheme == "https" else 80)
+        port = url.port or _default_port_for(url.scheme)
     except ValueError:
         raise _MalformedServiceSyntaxException(service)
     return host, port
 
 
-async def _wait_until_available(host, port):
-    family = 0 if socket.has_ipv6 else socket.AF_INET
-    while True:
+def _determine_probe_class_for(service):
+    scheme = _parse_service(service).scheme
+    return _PROBE_CLASS_FOR_SCHEME.get(scheme, _TcpProbe)
+
+
+def _default_port_for(scheme):
+    probe_class = _PROBE_CLASS_FOR_SCHEME.get(scheme)
+    if probe_class is not None and probe_class.default_port is not None:
+        return probe_class.default_port
+    return 443 if scheme == "https" else 80
+
+
+_PROBE_CLASS_FOR_SCHEME = {}
+
+_HANDSHAKE_TIMEOUT_SECONDS = 5
+
+
+def _register_probe(*schemes):
+    """Class decorator making a probe handle services of the given URL schemes"""
+
+    def decorator(probe_class):
+        for scheme in schemes:
+            _PROBE_CLASS_FOR_SCHEME[scheme] = probe_class
+        return probe_class
+
+    return decorator
+
+
+class _Phase(Enum):
+    RESOLVE = "resolve"
+    CONNECT = "connect"
+    HANDSHAKE = "handshake"
+    CLOSE = "close"
+    SLEEP = "sleep"
+
+
+class _ProbeHooks:
+    """Callbacks around each phase of probing a service, no-ops by default"""
+
+    def on_phase_start(self, probe, phase):
+        pass
+
+    def on_phase_end(self, probe, phase, error):
+        pass
+
+
+class _ObservedPhase:
+    def __init__(self, hooks, probe, phase):
+        self._hooks = hooks
+        self._probe = probe
+        self._phase = phase
+
+    def __enter__(self):
+        self._hooks.on_phase_start(self._probe, self._phase)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._hooks.on_phase_end(self._probe, self._phase, exc_value)
+        return False
+
+
+_UNOBSERVED_PHASE = nullcontext()
+
+
+class _ChromeTraceExporter(_ProbeHooks):
+    """
+    Records phases as events of the Chrome trace format,
+    for viewing with e.g. https://ui.perfetto.dev/ or chrome://tracing
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._events = []
+        self._started_at = {}
+        self._thread_id_for_probe = {}
+        self._epoch = time.perf_counter()
+
+    def on_phase_start(self, probe, phase):
+        self._started_at[probe, phase] = time.perf_counter()
+
+    def on_phase_end(self, probe, phase, error):
+        ended_at = time.perf_counter()
+        started_at = self._started_at.pop((probe, phase))
+        args = {"service": _friendly_name_for(probe.host, probe.port)}
+        if error is not None:
+            args["error"] = repr(error)
+        self._events.append(
+            {
+                "name": phase.value,
+                "ph": "X",
+                "ts": (started_at - self._epoch) * 1e6,
+                "dur": (ended_at - started_at) * 1e6,
+                "pid": os.getpid(),
+                "tid": self._thread_id_for(probe),
+                "args": args,
+            }
+        )
+
+    def _thread_id_for(self, probe):
+        """Give each probe a lane of its own, named after the service"""
+        if probe not in self._thread_id_for_probe:
+            thread_id = len(self._thread_id_for_probe) + 1
+            self._thread_id_for_probe[probe] = thread_id
+            self._events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": thread_id,
+                    "args": {"name": _friendly_name_for(probe.host, probe.port)},
+                }
+            )
+        return self._thread_id_for_probe[probe]
+
+    def write(self):
+        with open(self._filename, "w") as f:
+            json.dump({"traceEvents": self._events, "displayTimeUnit": "ms"}, f)
+
+
+class _TcpProbe:
+    """
+    Considers a service available as soon as a TCP connection can be made.
+
+    Subclasses speak just enough of a wire protocol in ``_handshake`` to tell
+    a listening socket apart from a service that is ready to serve requests.
+    A connection that received a "not ready yet" reply is kept for the next
+    attempt if ``connection_is_reusable`` is true.
+    """
+
+    default_port = None
+    connection_is_reusable = False
+
+    def __init__(self, host, port, hooks=None):
+        self.host = host
+        self.port = port
+        self._hooks = hooks
+        self._reader = None
+        self._writer = None
+
+    def observed(self, phase):
+        """Context manager reporting the given phase to the hooks, if any"""
+        if self._hooks is None:
+            return _UNOBSERVED_PHASE
+        return _ObservedPhase(self._hooks, self, phase)
+
+    async def attempt(self):
+        """Return whether the service is available, raise on connection trouble"""
+        if self._writer is None:
+            self._reader, self._writer = await self._connect()
         try:
-            _reader, writer = await asyncio.open_connection(host, port, family=family)
+            with self.observed(_Phase.HANDSHAKE):
+                ready = await asyncio.wait_for(
+                    self._handshake(self._reader, self._writer),
+                    _HANDSHAKE_TIMEOUT_SECONDS,
+                )
+        except (TypeError, ValueError) as e:
+            await self.close()
+            # A malformed reply is worth retrying, unlike a malformed target
+            raise ConnectionError(f"Malformed reply: {e}") from e
+        except BaseException:
+            await self.close()  # the stream is in an unknown state now
+            raise
+        if not ready and not self.connection_is_reusable:
+            await self.close()
+        return ready
+
+    async def close(self):
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is None:
+            return
+        with self.observed(_Phase.CLOSE):
             writer.close()
-            await writer.wait_closed()
-            break
-        except (socket.gaierror, ConnectionError, OSError, TypeError):
-            pass
-        await asyncio.sleep(1)
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _connect(self):
+        """
+        Try the resolved addresses in order, like ``asyncio.open_connection``,
+        but raise a failure common to all addresses as is rather than merged
+        into a plain ``OSError``, so that it can still be classified
+        """
+        loop = asyncio.get_running_loop()
+        family = 0 if socket.has_ipv6 else socket.AF_INET
+        with self.observed(_Phase.RESOLVE):
+            addresses = await loop.getaddrinfo(
+                self.host, self.port, family=family, type=socket.SOCK_STREAM
+            )
+
+        errors = []
+        with self.observed(_Phase.CONNECT):
+            for family, type_, proto, _canonname, address in addresses:
+                sock = socket.socket(family, type_, proto)
+                try:
+                    sock.setblocking(False)
+                    await loop.sock_connect(sock, address)
+                    return await asyncio.open_connection(sock=sock)
+                except OSError as e:
+                    sock.close()
+                    errors.append(e)
+                except BaseException:
+                    sock.close()
+                    raise
+
+            if len({(type(e), e.errno) for e in errors}) == 1:
+                raise errors[0]
+            raise OSError(f"Multiple exceptions: {', '.join(str(e) for e in errors)}")
+
+    async def _handshake(self, reader, writer):
+        return True
+
+
+@_register_probe("redis")
+class _RedisProbe(_TcpProbe):
+    default_port = 6379
+    connection_is_reusable = True
+
+    _NOT_READY_ERRORS = (b"-LOADING", b"-BUSY", b"-MASTERDOWN")
+
+    async def _handshake(self, reader, writer):
+        writer.write(b"*1\r\n$4\r\nPING\r\n")
+        await writer.drain()
+        reply = await reader.readuntil(b"\r\n")
+        if reply.startswith(b"+"):
+            return True
+        # Errors like "-NOAUTH" still prove that commands are being served
+        return reply.startswith(b"-") and not reply.startswith(self._NOT_READY_ERRORS)
+
+
+@_register_probe("postgres", "postgresql")
+class _PostgresProbe(_TcpProbe):
+    """
+    Sends a plain startup message rather than an SSLRequest: the server
+    answers an SSLRequest before checking whether it accepts connections,
+    but rejects a startup message with SQLSTATE 57P03 while starting up.
+    """
+
+    default_port = 5432
+
+    _PROTOCOL_VERSION_3_0 = 196608
+    _SQLSTATE_CANNOT_CONNECT_NOW = b"57P03"
+
+    async def _handshake(self, reader, writer):
+        parameters = b"user\0wait-for-it\0\0"
+        writer.write(
+            struct.pack("!ii", 8 + len(parameters), self._PROTOCOL_VERSION_3_0)
+            + parameters
+        )
+        await writer.drain()
+        message_type, length = struct.unpack("!ci", await reader.readexactly(5))
+        if message_type in (b"R", b"v"):  # authentication request, version negotiation
+            return True
+        if message_type != b"E":
+            return False
+        fields = (await reader.readexactly(length - 4)).split(b"\0")
+        return b"C" + self._SQLSTATE_CANNOT_CONNECT_NOW not in fields
+
+
+@_register_probe("amqp")
+class _AmqpProbe(_TcpProbe):
+    default_port = 5672
+
+    _PROTOCOL_HEADER_0_9_1 = b"AMQP\0\0\x09\x01"
+    _FRAME_TYPE_METHOD = 1
+
+    async def _handshake(self, reader, writer):
+        writer.write(self._PROTOCOL_HEADER_0_9_1)
+        await writer.drain()
+        reply = await reader.readexactly(7)
+        if reply.startswith(b"AMQP"):  # a supported protocol version is suggested
+            return True
+        # Servers ready for clients open with a Connection.Start method frame
+        frame_type, channel, _size = struct.unpack("!BHI", reply)
+        return frame_type == self._FRAME_TYPE_METHOD and channel == 0
+
+
+@_register_probe("kafka")
+class _KafkaProbe(_TcpProbe):
+    default_port = 9092
+    connection_is_reusable = True
+
+    _API_KEY_API_VERSIONS = 18
+    _ERROR_CODE_NONE = 0
+    _ERROR_CODE_UNSUPPORTED_VERSION = 35
+    _CLIENT_ID = b"wait-for-it"
+
+    def __init__(self, host, port, hooks=None):
+        super().__init__(host, port, hooks)
+        self._correlation_id = 0
+
+    async def _handshake(self, reader, writer):
+        self._correlation_id += 1
+        request = struct.pack(
+            "!hhih",
+            self._API_KEY_API_VERSIONS,
+            0,
+            self._correlation_id,
+            len(self._CLIENT_ID),
+        )
+        request += self._CLIENT_ID
+        writer.write(struct.pack("!i", len(request)) + request)
+        await writer.drain()
+        (size,) = struct.unpack("!i", await reader.readexactly(4))
+        correlation_id, error_code = struct.unpack(
+            "!ih", (await reader.readexactly(size))[:6]
+        )
+        if correlation_id != self._correlation_id:
+            raise ConnectionError("Kafka response does not match request")
+        return error_code in (
+            self._ERROR_CODE_NONE,
+            self._ERROR_CODE_UNSUPPORTED_VERSION,
+        )
 
 
-async def _wait_until_available_and_report(reporter, host, port):
+class _FailureCategory(Enum):
+    REFUSED = "refused"
+    NOT_READY = "not ready"
+    UNREACHABLE = "unreachable"
+    DNS = "dns"
+    PERMANENT = "permanent"
+
+
+class _RetryPolicy:
+    """
+    Delays retries of the same category of failure exponentially,
+    from ``initial_delay`` up to ``max_delay`` seconds.
+    """
+
+    def __init__(self, initial_delay=None, max_delay=None, fail_fast=False):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay if max_delay is not None else initial_delay
+        self.fail_fast = fail_fast
+
+    _MAX_EXPONENT = 32  # keeps the float multiplication from overflowing
+
+    def delay_after(self, consecutive_failures):
+        exponent = min(consecutive_failures - 1, self._MAX_EXPONENT)
+        return min(self.initial_delay * 2**exponent, self.max_delay)
+
+
+# Every attempt that needs a new connection resolves the host name again,
+# so DNS failures only need to be given time to go away.
+_RETRY_POLICY_FOR_CATEGORY = {
+    _FailureCategory.REFUSED: _RetryPolicy(0.1, 0.5),
+    _FailureCategory.NOT_READY: _RetryPolicy(1),
+    _FailureCategory.UNREACHABLE: _RetryPolicy(1, 4),
+    _FailureCategory.DNS: _RetryPolicy(1, 4),
+    _FailureCategory.PERMANENT: _RetryPolicy(fail_fast=True),
+}
+
+# Resolution errors caused by the target itself rather than by the resolver
+_PERMANENT_DNS_ERRORS = {
+    getattr(socket, name)
+    for name in ("EAI_BADFLAGS", "EAI_FAMILY", "EAI_SERVICE", "EAI_SOCKTYPE")
+    if hasattr(socket, name)
+}
+
+_UNREACHABLE_ERRORS = {
+    errno.EHOSTDOWN,
+    errno.EHOSTUNREACH,
+    errno.ENETDOWN,
+    errno.ENETUNREACH,
+    errno.ETIMEDOUT,
+}
+
+
+def _classify_failure(error):
+    if isinstance(error, socket.gaierror):
+        if error.errno in _PERMANENT_DNS_ERRORS:
+            return _FailureCategory.PERMANENT
+        return _FailureCategory.DNS
+    if isinstance(error, ConnectionRefusedError):
+        return _FailureCategory.REFUSED
+    if isinstance(error, OSError) and error.errno in _UNREACHABLE_ERRORS:
+        return _FailureCategory.UNREACHABLE
+    if isinstance(error, (TypeError, ValueError)):  # e.g. an invalid host name
+        return _FailureCategory.PERMANENT
+    return _FailureCategory.NOT_READY
+
+
+async def _wait_until_available(probe):
+    previous_category = None
+    consecutive_failures = 0
+    try:
+        while True:
+            try:
+                if await probe.attempt():
+                    break
+                category = _FailureCategory.NOT_READY
+            except (
+                OSError,
+                TypeError,
+                ValueError,
+                EOFError,
+                asyncio.LimitOverrunError,
+                asyncio.TimeoutError,
+                struct.error,
+            ) as e:
+                category = _classify_failure(e)
+                if _RETRY_POLICY_FOR_CATEGORY[category].fail_fast:
+                    raise _PermanentFailureException(probe.host, probe.port, e) from e
+
+            if category is previous_category:
+                consecutive_failures += 1
+            else:
+                previous_category = category
+                consecutive_failures = 1
+            policy = _RETRY_POLICY_FOR_CATEGORY[category]
+            with probe.observed(_Phase.SLEEP):
+                await asyncio.sleep(policy.delay_after(consecutive_failures))
+    finally:
+        await probe.close()
+
+
+async def _wait_until_available_and_report(reporter, probe):
     reporter.on_before_start()
-    await _wait_until_available(host, port)
+    await _wait_until_available(probe)
     reporter.on_success()
 
 
@@ -89,8 +507,19 @@ async def _wait_until_available_and_report(reporter, host, port):
     "':port', "
     "'hostname:port', "
     "'v4addr:port', "
-    "'[v6addr]:port' or "
-    "'https://...'",
+    "'[v6addr]:port', "
+    "'https://...', "
+    "'redis://...', "
+    "'postgres://...', "
+    "'amqp://...' or "
+    "'kafka://...'",
+)
+@click.option(
+    "--trace",
+    type=click.Path(dir_okay=False, writable=True),
+    metavar="path",
+    help="Write the timing of resolving, connecting, handshaking, "
+    "closing and sleeping to a file in Chrome trace format",
 )
 @click.argument("commands", nargs=-1)
 def cli(**kwargs):
@@ -102,14 +531,26 @@ def cli(**kwargs):
         sys.exit(1)
 
 
-def _cli_internal(service, quiet, parallel, timeout, commands):
+def _friendly_name_for(host, port):
+    if host is None:
+        host = ""
+    host_is_an_ipv6_address = ":" in host
+    return f"[{host}]:{port}" if host_is_an_ipv6_address else f"{host}:{port}"
+
+
+def _cli_internal(service, quiet, parallel, timeout, trace, commands):
     if quiet:
         sys.stdout = open(os.devnull, "w")
 
-    if parallel:
-        _connect_all_parallel(service, timeout)
-    else:
-        _connect_all_serial(service, timeout)
+    hooks = _ChromeTraceExporter(trace) if trace else None
+    try:
+        if parallel:
+            _connect_all_parallel(service, timeout, hooks)
+        else:
+            _connect_all_serial(service, timeout, hooks)
+    finally:
+        if hooks is not None:
+            hooks.write()
 
     if commands:
         try:
@@ -147,12 +588,7 @@ class _Messenger:
 
 class _ConnectionJobReporter:
     def __init__(self, host, port, timeout):
-        if host is None:
-            host = ""
-        host_is_an_ipv6_address = ":" in host
-        self._friendly_name = (
-            f"[{host}]:{port}" if host_is_an_ipv6_address else f"{host}:{port}"
-        )
+        self._friendly_name = _friendly_name_for(host, port)
         self._timeout = timeout
         self._started_at = None
         self.job_successful = None
@@ -189,13 +625,14 @@ def _exit_on_timeout(timeout, on_exit):
         signal.signal(signal.SIGALRM, _handle_timeout)
         signal.alarm(timeout)
 
-    yield
-
-    if timeout > 0:
-        signal.alarm(0)  # disarm sys-exit timer
+    try:
+        yield
+    finally:
+        if timeout > 0:
+            signal.alarm(0)  # disarm sys-exit timer
 
 
-async def _connect_all_parallel_async(services, timeout):
+async def _connect_all_parallel_async(services, timeout, hooks):
     if not services:
         return
 
@@ -204,11 +641,10 @@ async def _connect_all_parallel_async(services, timeout):
 
     for service in services:
         host, port = _determine_host_and_port_for(service)
+        probe = _determine_probe_class_for(service)(host, port, hooks)
         reporter = _ConnectionJobReporter(host, port, timeout)
         reporters.append(reporter)
-        connect_job_awaitables.append(
-            _wait_until_available_and_report(reporter, host, port)
-        )
+        connect_job_awaitables.append(_wait_until_available_and_report(reporter, probe))
 
     def _report_on_all_unsuccessful_jobs():
         for reporter in reporters:
@@ -217,26 +653,30 @@ async def _connect_all_parallel_async(services, timeout):
             reporter.on_timeout()
 
     with _exit_on_timeout(timeout, on_exit=_report_on_all_unsuccessful_jobs):
-        await asyncio.wait(
-            [asyncio.ensure_future(coro) for coro in connect_job_awaitables]
+        done, _pending = await asyncio.wait(
+            [asyncio.ensure_future(coro) for coro in connect_job_awaitables],
+            return_when=asyncio.FIRST_EXCEPTION,
         )
+        for task in done:
+            task.result()  # re-raises a permanent failure, if any
 
 
-def _connect_all_parallel(services, timeout):
-    asyncio.run(_connect_all_parallel_async(services, timeout))
+def _connect_all_parallel(services, timeout, hooks=None):
+    asyncio.run(_connect_all_parallel_async(services, timeout, hooks))
 
 
-def _connect_all_serial(services, timeout):
+def _connect_all_serial(services, timeout, hooks=None):
     for service in services:
-        connect(service, timeout)
+        connect(service, timeout, hooks)
 
 
-def connect(service, timeout):
+def connect(service, timeout, hooks=None):
     host, port = _determine_host_and_port_for(service)
+    probe = _determine_probe_class_for(service)(host, port, hooks)
     reporter = _ConnectionJobReporter(host, port, timeout)
 
     with _exit_on_timeout(timeout, on_exit=reporter.on_timeout):
-        asyncio.run(_wait_until_available_and_report(reporter, host, port))
+        asyncio.run(_wait_until_available_and_report(reporter, probe))
 
 
 if __name__ == "__main__":